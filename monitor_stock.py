@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
+import atexit
+import base64
+import codecs
+import functools
+import gzip
+import http.client
 import json
 import logging
 import os
+import queue
+import re
 import smtplib
+import string
 import sys
+import threading
+import urllib.error
 import urllib.request
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from email.message import EmailMessage
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 from typing import Any
+from urllib.parse import SplitResult, quote, unquote, urljoin, urlsplit, urlunsplit
 
 PROJECT_DIR = Path(__file__).resolve().parent
 
@@ -28,7 +42,21 @@ LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
 
 MONITOR_CONFIG_FILE = resolve_project_path("MONITOR_CONFIG_FILE", "monitor_targets.json")
 MONITOR_STATE_FILE = resolve_project_path("MONITOR_STATE_FILE", "monitor_state.json")
+STATE_FSYNC = os.environ.get("STATE_FSYNC", "1") not in {"0", "false", "False"}
 HTTP_TIMEOUT_SECONDS = int(os.environ.get("HTTP_TIMEOUT_SECONDS", "30"))
+HTTP_MAX_WORKERS = max(1, int(os.environ.get("HTTP_MAX_WORKERS", "8")))
+HTTP_MAX_PER_HOST = max(1, int(os.environ.get("HTTP_MAX_PER_HOST", "6")))
+HTTP_MAX_REDIRECTS = 10
+HTTP_CHUNK_SIZE = 16384
+# Apres un terme trouve tot, reste de page lu (et jete) pour garder la
+# connexion keep-alive; au-dela, fermer coute moins cher que tout lire.
+HTTP_DRAIN_MAX_BYTES = 256 * 1024
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.8",
+}
+HTTP_REDIRECT_CODES = {301, 302, 303, 307, 308}
 
 SMTP_HOST = os.environ.get("SMTP_HOST", "")
 SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
@@ -36,6 +64,22 @@ SMTP_USER = os.environ.get("SMTP_USER", "")
 SMTP_PASS = os.environ.get("SMTP_PASS", "")
 EMAIL_FROM = os.environ.get("EMAIL_FROM", "") or SMTP_USER
 SMTP_USE_TLS = os.environ.get("SMTP_USE_TLS", "1") not in {"0", "false", "False"}
+SMTP_MISSING = [
+    name
+    for name, value in (
+        ("SMTP_HOST", SMTP_HOST),
+        ("SMTP_PORT", SMTP_PORT),
+        ("SMTP_USER", SMTP_USER),
+        ("SMTP_PASS", SMTP_PASS),
+        ("EMAIL_FROM", EMAIL_FROM),
+    )
+    if not value
+]
+
+STATE_ENCODER = json.JSONEncoder(indent=2, sort_keys=True)
+# Etat compresse (MONITOR_STATE_FILE en .gz): pas besoin d'indentation.
+STATE_COMPACT_ENCODER = json.JSONEncoder(separators=(",", ":"), sort_keys=True)
+GZIP_MAGIC = b"\x1f\x8b"
 
 logger = logging.getLogger("stock_monitor")
 if not logger.handlers:
@@ -53,8 +97,18 @@ if not logger.handlers:
         backupCount=LOG_BACKUP_COUNT,
     )
     file_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    # Les ecritures console/fichier se font dans le thread du listener: log()
+    # se contente de mettre l'enregistrement en file.
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(
+        log_queue,
+        stream_handler,
+        file_handler,
+        respect_handler_level=True,
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
 
 def log(message: str) -> None:
@@ -124,14 +178,28 @@ def parse_schedule(raw_schedule: Any, target_name: str) -> dict[str, Any]:
     )
 
 
+def compile_terms_pattern(terms: list[str]) -> re.Pattern[str]:
+    """Regroupe les termes en une seule alternance insensible a la casse, un groupe par terme."""
+    return re.compile("|".join(f"({re.escape(term)})" for term in terms), re.IGNORECASE)
+
+
 def load_monitor_config(path: Path) -> dict[str, Any]:
-    if not path.exists():
+    """Ne relit le fichier que si sa date de modification ou sa taille a change.
+
+    La configuration renvoyee est partagee entre les appels: ne pas la modifier.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
         raise FileNotFoundError(
             f"Fichier de configuration introuvable: {path}. Creez-le a partir du .example."
-        )
+        ) from None
+    return _parse_monitor_config(str(path), stat.st_mtime_ns, stat.st_size)
+
 
-    with path.open("r", encoding="utf-8") as handle:
-        raw = json.load(handle)
+@functools.lru_cache(maxsize=4)
+def _parse_monitor_config(path_str: str, mtime_ns: int, size: int) -> dict[str, Any]:
+    raw = json.loads(Path(path_str).read_bytes())
 
     if not isinstance(raw, dict):
         raise ValueError("La configuration doit etre un objet JSON.")
@@ -188,6 +256,8 @@ def load_monitor_config(path: Path) -> dict[str, Any]:
             target_name,
         )
         notify_on_same_state = bool(target.get("notify_on_same_state", False))
+        # Derives des termes calcules une fois ici plutot qu'a chaque verification.
+        terms = in_stock_terms or out_of_stock_terms
 
         targets.append(
             {
@@ -196,6 +266,15 @@ def load_monitor_config(path: Path) -> dict[str, Any]:
                 "url": url,
                 "in_stock_terms": in_stock_terms,
                 "out_of_stock_terms": out_of_stock_terms,
+                "terms": terms,
+                "terms_label": ", ".join(terms),
+                "terms_pattern": compile_terms_pattern(terms),
+                "terms_max_length": max(map(len, terms)),
+                # Identifie ce qui a produit un etat en cache: une reponse 304 ne
+                # vaut que pour la meme URL, le meme mode et les memes termes.
+                "cache_key": "\n".join(
+                    [url, "in_stock_terms" if in_stock_terms else "out_of_stock_terms"] + terms
+                ),
                 "schedule": schedule,
                 "emails_on_out_of_stock": emails_on_out_of_stock,
                 "emails_on_in_stock": emails_on_in_stock,
@@ -214,6 +293,13 @@ def load_monitor_config(path: Path) -> dict[str, Any]:
 def parse_iso_datetime(raw_value: Any) -> datetime | None:
     if not isinstance(raw_value, str) or not raw_value:
         return None
+    return _parse_iso_string(raw_value)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_iso_string(raw_value: str) -> datetime | None:
+    # Les datetime sont immuables: un meme horodatage peut etre partage entre
+    # cibles et entre cycles.
     try:
         return datetime.fromisoformat(raw_value)
     except ValueError:
@@ -221,12 +307,15 @@ def parse_iso_datetime(raw_value: Any) -> datetime | None:
 
 
 def load_state(path: Path) -> dict[str, Any]:
-    if not path.exists():
-        return {"targets": {}}
-
     try:
-        with path.open("r", encoding="utf-8") as handle:
-            state = json.load(handle)
+        data = path.read_bytes()
+        # Detection par signature: un etat JSON brut reste lisible apres
+        # passage a un fichier .gz, et inversement.
+        if data[:2] == GZIP_MAGIC:
+            data = gzip.decompress(data)
+        state = json.loads(data)
+    except FileNotFoundError:
+        return {"targets": {}}
     except Exception as exc:  # pragma: no cover
         log(f"STATE: lecture impossible ({exc}), recreation de l'etat.")
         return {"targets": {}}
@@ -238,41 +327,442 @@ def load_state(path: Path) -> dict[str, Any]:
     return state
 
 
+@functools.lru_cache(maxsize=None)
+def ensure_directory(path: Path) -> None:
+    # Le dossier de l'etat ne change pas en cours d'execution: un seul mkdir.
+    path.mkdir(parents=True, exist_ok=True)
+
+
 def save_state(path: Path, state: dict[str, Any]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    tmp_path = path.with_suffix(path.suffix + ".tmp")
-    payload = json.dumps(state, indent=2, sort_keys=True) + "\n"
-    tmp_path.write_text(payload, encoding="utf-8")
-    tmp_path.replace(path)
-
-
-def fetch_html(url: str) -> str:
-    request = urllib.request.Request(
-        url,
-        headers={
-            "User-Agent": "Mozilla/5.0 (X11; Linux) AppleWebKit/537.36 "
-            "(KHTML, like Gecko) Chrome/120.0 Safari/537.36",
-            "Accept-Language": "fr-FR,fr;q=0.9,en;q=0.8",
-        },
-    )
-    with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT_SECONDS) as response:
-        return response.read().decode("utf-8", errors="replace")
-
-
-def send_email(subject: str, body: str, recipients: list[str]) -> bool:
-    missing = []
-    if not SMTP_HOST:
-        missing.append("SMTP_HOST")
-    if not SMTP_PORT:
-        missing.append("SMTP_PORT")
-    if not SMTP_USER:
-        missing.append("SMTP_USER")
-    if not SMTP_PASS:
-        missing.append("SMTP_PASS")
-    if not EMAIL_FROM:
-        missing.append("EMAIL_FROM")
-    if missing:
-        log("EMAIL: configuration SMTP incomplete: " + ", ".join(missing))
+    ensure_directory(path.parent)
+    tmp_path = f"{path}.tmp"
+    if path.suffix == ".gz":
+        payload = gzip.compress(
+            STATE_COMPACT_ENCODER.encode(state).encode("utf-8"),
+            compresslevel=6,
+            mtime=0,
+        )
+    else:
+        payload = (STATE_ENCODER.encode(state) + "\n").encode("utf-8")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        # Sans fsync, une coupure juste apres le replace peut laisser un
+        # fichier d'etat vide sur certains systemes de fichiers.
+        if STATE_FSYNC:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+
+_http_local = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def proxy_for(scheme: str, netloc: str) -> SplitResult | None:
+    """Proxy a utiliser pour cet hote (http_proxy, https_proxy, no_proxy), comme urlopen."""
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(netloc):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    return urlsplit(proxy)
+
+
+def proxy_auth_headers(proxy: SplitResult) -> dict[str, str]:
+    if proxy.username is None:
+        return {}
+    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+    token = base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+    return {"Proxy-Authorization": f"Basic {token}"}
+
+
+def get_http_connection(scheme: str, netloc: str) -> http.client.HTTPConnection:
+    """Renvoie une connexion keep-alive par hote, propre au thread courant."""
+    connections = getattr(_http_local, "connections", None)
+    if connections is None:
+        connections = _http_local.connections = {}
+    key = (scheme, netloc)
+    connection = connections.get(key)
+    if connection is None:
+        if scheme not in {"http", "https"}:
+            raise ValueError(f"schema d'URL non supporte: {scheme or '(vide)'}")
+        connection_class = (
+            http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        )
+        proxy = proxy_for(scheme, netloc)
+        if proxy is None:
+            connection = connection_class(netloc, timeout=HTTP_TIMEOUT_SECONDS)
+        else:
+            # HTTPS: tunnel CONNECT via le proxy, le TLS reste de bout en bout.
+            # HTTP: requetes en URI absolue envoyees directement au proxy.
+            proxy_address = proxy.netloc.rpartition("@")[2]
+            connection = connection_class(proxy_address, timeout=HTTP_TIMEOUT_SECONDS)
+            if scheme == "https":
+                connection.set_tunnel(netloc, headers=proxy_auth_headers(proxy))
+        connections[key] = connection
+    return connection
+
+
+def close_http_connections() -> None:
+    """Ferme les connexions keep-alive du thread courant (fin de sa file d'hote)."""
+    connections = getattr(_http_local, "connections", {})
+    while connections:
+        _, connection = connections.popitem()
+        connection.close()
+
+
+def drop_http_connection(scheme: str, netloc: str) -> None:
+    connection = getattr(_http_local, "connections", {}).pop((scheme, netloc), None)
+    if connection is not None:
+        connection.close()
+
+
+def open_http_response(url: str, headers: dict[str, str]) -> http.client.HTTPResponse:
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    proxy = proxy_for(parts.scheme, parts.netloc)
+    if proxy is not None and parts.scheme == "http":
+        path = urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+        headers = {**headers, **proxy_auth_headers(proxy)}
+
+    def send_request() -> http.client.HTTPResponse:
+        connection = get_http_connection(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            return connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            drop_http_connection(parts.scheme, parts.netloc)
+            raise
+
+    connection = getattr(_http_local, "connections", {}).get((parts.scheme, parts.netloc))
+    reused = connection is not None and connection.sock is not None
+    try:
+        return send_request()
+    except (http.client.HTTPException, OSError):
+        if not reused:
+            raise
+    # La connexion reutilisee avait ete fermee par le serveur entre deux
+    # requetes: une seule nouvelle tentative, sur une connexion neuve.
+    return send_request()
+
+
+def release_http_response(url: str, response: http.client.HTTPResponse, drained: bool) -> None:
+    """Garde la connexion pour la requete suivante seulement si la reponse a ete lue en entier."""
+    if not drained or response.will_close:
+        parts = urlsplit(url)
+        drop_http_connection(parts.scheme, parts.netloc)
+    response.close()
+
+
+def drain_http_response(response: http.client.HTTPResponse) -> bool:
+    """Lit la fin d'une reponse si elle reste petite; True si elle a ete lue en entier."""
+    remaining = HTTP_DRAIN_MAX_BYTES
+    if response.length is not None and response.length > remaining:
+        return False
+    try:
+        while remaining >= 0:
+            chunk = response.read(min(HTTP_CHUNK_SIZE, remaining + 1))
+            if not chunk:
+                return True
+            remaining -= len(chunk)
+    except (http.client.HTTPException, OSError):
+        return False
+    return False
+
+
+def scan_url(
+    url: str,
+    pattern: re.Pattern[str],
+    max_term_length: int,
+    validators: dict[str, str] | None = None,
+) -> dict[str, Any]:
+    """Lit la page par blocs et s'arrete des qu'un terme est trouve.
+
+    Seule la fin du texte deja lu (longueur du plus long terme moins un) est
+    gardee d'un bloc a l'autre, pour les termes a cheval sur deux blocs.
+    Avec `validators` (etag / last_modified d'une verification precedente),
+    la requete est conditionnelle et un 304 est renvoye sans lire de corps.
+    Apres un terme trouve, un petit reste de page est vide pour que la
+    connexion reste reutilisable (voir drain_http_response).
+    """
+    headers = dict(HTTP_HEADERS)
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    for _ in range(HTTP_MAX_REDIRECTS + 1):
+        response = open_http_response(url, headers)
+        location = response.getheader("Location")
+        if (response.status in HTTP_REDIRECT_CODES and location) or response.status >= 400:
+            response.read()
+            release_http_response(url, response, drained=True)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            # Comme HTTPRedirectHandler: Location peut contenir espaces ou
+            # caracteres non ASCII (slugs accentues), a encoder avant de suivre.
+            redirect_url = urljoin(
+                url, quote(location, encoding="iso-8859-1", safe=string.punctuation)
+            )
+            if urlsplit(redirect_url).netloc != urlsplit(url).netloc:
+                # Les validateurs ne valent que pour l'hote qui les a emis.
+                headers.pop("If-None-Match", None)
+                headers.pop("If-Modified-Since", None)
+            url = redirect_url
+            continue
+
+        result: dict[str, Any] = {
+            "match": None,
+            "not_modified": response.status == 304,
+            "etag": response.getheader("ETag", ""),
+            "last_modified": response.getheader("Last-Modified", ""),
+        }
+        if result["not_modified"]:
+            response.read()
+            release_http_response(url, response, drained=True)
+            return result
+
+        # Methodes liees une fois pour toutes: la boucle ne fait plus que des
+        # appels directs au decodeur et au moteur regex compile pour la cible.
+        read = response.read
+        decode = codecs.getincrementaldecoder("utf-8")(errors="replace").decode
+        search = pattern.search
+        overlap = max_term_length - 1
+        tail = ""
+        drained = False
+        try:
+            while True:
+                chunk = read(HTTP_CHUNK_SIZE)
+                text = decode(chunk, final=not chunk)
+                # Le bloc est analyse tel quel; seule la jonction avec le bloc
+                # precedent (quelques caracteres) est recopiee.
+                match = search(tail + text[:overlap]) if tail else None
+                if match is None:
+                    match = search(text)
+                if match or not chunk:
+                    drained = not chunk or drain_http_response(response)
+                    result["match"] = match
+                    return result
+                if overlap:
+                    tail = text[-overlap:] if len(text) >= overlap else (tail + text)[-overlap:]
+        finally:
+            release_http_response(url, response, drained)
+    raise urllib.error.HTTPError(url, response.status, "trop de redirections", response.headers, None)
+
+
+def http_validators(target: dict[str, Any], target_state: dict[str, Any]) -> dict[str, str] | None:
+    """Validateurs HTTP stockes, s'ils valent encore pour cette URL, ces termes et un etat connu."""
+    cache = target_state.get("http_cache")
+    if not isinstance(cache, dict) or cache.get("cache_key") != target["cache_key"]:
+        return None
+    if target_state.get("last_state") not in {"in_stock", "out_of_stock"}:
+        return None
+    return cache
+
+
+def scan_or_error(
+    target: dict[str, Any],
+    target_state: dict[str, Any],
+) -> dict[str, Any] | Exception:
+    # Journalise dans le worker, au moment reel du telechargement.
+    log(f"[{target['name']}] verification de {target['url']}")
+    try:
+        return scan_url(
+            target["url"],
+            target["terms_pattern"],
+            target["terms_max_length"],
+            http_validators(target, target_state),
+        )
+    except Exception as exc:
+        log(f"[{target['name']}] ERREUR HTTP: {exc}")
+        return exc
+
+
+def scan_pages(
+    due_targets: list[tuple[dict[str, Any], dict[str, Any]]],
+) -> list[dict[str, Any] | Exception]:
+    """Analyse les pages en parallele; l'ordre du resultat suit celui des cibles.
+
+    Les cibles d'un meme hote sont reparties sur au plus HTTP_MAX_PER_HOST
+    workers qui se partagent sa file: chacun garde sa connexion keep-alive
+    d'une page a l'autre, sans sacrifier la concurrence. La connexion n'est
+    perdue que si une page abandonnee sur un terme trouve tot a encore plus
+    de HTTP_DRAIN_MAX_BYTES a telecharger.
+    """
+    host_groups: dict[tuple[str, str], list[int]] = {}
+    for index, (target, _) in enumerate(due_targets):
+        parts = urlsplit(target["url"])
+        host_groups.setdefault((parts.scheme, parts.netloc), []).append(index)
+
+    results: list[dict[str, Any] | Exception | None] = [None] * len(due_targets)
+    jobs: list[queue.SimpleQueue[int]] = []
+    for indexes in host_groups.values():
+        pending: queue.SimpleQueue[int] = queue.SimpleQueue()
+        for index in indexes:
+            pending.put(index)
+        jobs.extend([pending] * min(HTTP_MAX_PER_HOST, len(indexes)))
+
+    def drain_host_queue(pending: queue.SimpleQueue[int]) -> None:
+        try:
+            while True:
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    return
+                results[index] = scan_or_error(*due_targets[index])
+        finally:
+            close_http_connections()
+
+    if len(jobs) <= 1:
+        for pending in jobs:
+            drain_host_queue(pending)
+    else:
+        with ThreadPoolExecutor(max_workers=min(HTTP_MAX_WORKERS, len(jobs))) as pool:
+            list(pool.map(drain_host_queue, jobs))
+    return results
+
+
+class PipeliningSMTP(smtplib.SMTP):
+    """Envoie MAIL, RCPT et DATA d'un coup quand le serveur annonce PIPELINING (RFC 2920)."""
+
+    def reset_quietly(self) -> None:
+        # Meme role que smtplib.SMTP._rset (prive), via l'API publique.
+        try:
+            self.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def sendmail(
+        self,
+        from_addr: str,
+        to_addrs: str | Sequence[str],
+        msg: str | bytes,
+        mail_options: Sequence[str] = (),
+        rcpt_options: Sequence[str] = (),
+    ) -> dict[str, tuple[int, bytes]]:
+        self.ehlo_or_helo_if_needed()
+        if not self.does_esmtp or not self.has_extn("pipelining"):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        if isinstance(msg, str):
+            # Normalise les fins de ligne en CRLF, comme smtplib._fix_eols.
+            msg = re.sub(r"(?:\r\n|\n|\r(?!\n))", smtplib.CRLF, msg).encode("ascii")
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        mail_opts = list(mail_options)
+        if self.has_extn("size"):
+            mail_opts.insert(0, f"size={len(msg)}")
+        if any(option.lower() == "smtputf8" for option in mail_opts):
+            if not self.has_extn("smtputf8"):
+                raise smtplib.SMTPNotSupportedError("SMTPUTF8 not supported by server")
+            self.command_encoding = "utf-8"
+        mail_args = (" " + " ".join(mail_opts)) if mail_opts else ""
+        rcpt_args = (" " + " ".join(rcpt_options)) if rcpt_options else ""
+
+        commands = [f"mail FROM:{smtplib.quoteaddr(from_addr)}{mail_args}"]
+        commands.extend(f"rcpt TO:{smtplib.quoteaddr(addr)}{rcpt_args}" for addr in to_addrs)
+        commands.append("data")
+        self.send("".join(command + smtplib.CRLF for command in commands))
+
+        # Toutes les reponses sont lues avant de decider, pour garder le flux synchronise.
+        mail_code, mail_resp = self.getreply()
+        rcpt_replies = [self.getreply() for _ in to_addrs]
+        data_code, data_resp = self.getreply()
+
+        senderrs = {
+            addr: reply
+            for addr, reply in zip(to_addrs, rcpt_replies)
+            if reply[0] not in (250, 251)
+        }
+        if 421 in (mail_code, data_code) or any(code == 421 for code, _ in rcpt_replies):
+            self.close()
+            if mail_code != 250:
+                raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if mail_code != 250 or len(senderrs) == len(to_addrs):
+            if data_code == 354:
+                self.send(b"." + smtplib.bCRLF)
+                self.getreply()
+            self.reset_quietly()
+            if mail_code != 250:
+                raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if data_code != 354:
+            self.reset_quietly()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        # Equivalent de smtplib._quote_periods (interne a CPython): double
+        # le point en debut de ligne (RFC 5321, 4.5.2).
+        payload = re.sub(rb"(?m)^\.", b"..", msg)
+        if payload[-2:] != smtplib.bCRLF:
+            payload += smtplib.bCRLF
+        self.send(payload + b"." + smtplib.bCRLF)
+        code, resp = self.getreply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self.reset_quietly()
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+
+class SmtpSession:
+    """Connexion SMTP ouverte a la premiere notification puis reutilisee."""
+
+    def __init__(self) -> None:
+        self.server: smtplib.SMTP | None = None
+
+    def connect(self) -> smtplib.SMTP:
+        server = PipeliningSMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        try:
+            if SMTP_USE_TLS:
+                server.starttls()
+            server.login(SMTP_USER, SMTP_PASS)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        return server
+
+    def send(self, msg: EmailMessage) -> None:
+        if self.server is None:
+            self.connect().send_message(msg)
+            return
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self.server = None
+            self.connect().send_message(msg)
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+
+def send_email(
+    subject: str,
+    body: str,
+    recipients: list[str],
+    *,
+    smtp: SmtpSession | None = None,
+) -> bool:
+    if SMTP_MISSING:
+        log("EMAIL: configuration SMTP incomplete: " + ", ".join(SMTP_MISSING))
         return False
 
     if not recipients:
@@ -284,35 +774,30 @@ def send_email(subject: str, body: str, recipients: list[str]) -> bool:
     msg["To"] = ", ".join(recipients)
     msg.set_content(body)
 
+    session = smtp if smtp is not None else SmtpSession()
     try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as server:
-            if SMTP_USE_TLS:
-                server.starttls()
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
+        session.send(msg)
         log("EMAIL: notification envoyee a " + ", ".join(recipients))
         return True
     except Exception as exc:
         log(f"EMAIL: echec d'envoi: {exc}")
+        session.close()
         return False
+    finally:
+        if smtp is None:
+            session.close()
 
 
-def detect_target_state(
-    html: str,
-    in_stock_terms: list[str],
-    out_of_stock_terms: list[str],
-) -> tuple[str, str]:
-    """Renvoie (etat, marqueur) : in_stock ou out_of_stock selon le mode cible."""
-    lower_html = html.lower()
-    if in_stock_terms:
-        for marker in in_stock_terms:
-            if marker.lower() in lower_html:
-                return "in_stock", marker
-        return "out_of_stock", ""
-    for marker in out_of_stock_terms:
-        if marker.lower() in lower_html:
-            return "out_of_stock", marker
-    return "in_stock", ""
+def detect_target_state(match: re.Match[str] | None, target: dict[str, Any]) -> tuple[str, str]:
+    """Renvoie (etat, marqueur) : in_stock ou out_of_stock selon le mode cible.
+
+    `match` est la recherche renvoyee par scan_url: le marqueur renvoye est le
+    premier terme rencontre dans la page.
+    """
+    marker = target["terms"][match.lastindex - 1] if match else ""
+    if target["in_stock_terms"]:
+        return ("in_stock", marker) if match else ("out_of_stock", "")
+    return ("out_of_stock", marker) if match else ("in_stock", "")
 
 
 def is_target_due(target: dict[str, Any], target_state: dict[str, Any], now: datetime) -> bool:
@@ -336,26 +821,26 @@ def is_target_due(target: dict[str, Any], target_state: dict[str, Any], now: dat
 def evaluate_target(
     target: dict[str, Any],
     target_state: dict[str, Any],
-    now: datetime,
+    now_iso: str,
+    page: dict[str, Any] | Exception,
+    notifications: list[dict[str, Any]],
 ) -> bool:
     target_name = target["name"]
     url = target["url"]
     previous_state = target_state.get("last_state")
 
-    log(f"[{target_name}] verification de {url}")
-    try:
-        html = fetch_html(url)
-    except Exception as exc:
-        log(f"[{target_name}] ERREUR HTTP: {exc}")
+    # La page a deja ete telechargee par scan_pages (erreur journalisee la-bas).
+    if isinstance(page, Exception):
         target_state["last_state"] = "unknown"
-        target_state["last_check_at"] = now.isoformat(timespec="seconds")
+        target_state["last_check_at"] = now_iso
         return False
 
-    current_state, marker = detect_target_state(
-        html,
-        target["in_stock_terms"],
-        target["out_of_stock_terms"],
-    )
+    if page["not_modified"]:
+        current_state = previous_state
+        marker = target_state.get("last_marker", "")
+        log(f"[{target_name}] page non modifiee (HTTP 304), etat precedent conserve.")
+    else:
+        current_state, marker = detect_target_state(page["match"], target)
     if target["in_stock_terms"]:
         if current_state == "in_stock":
             log(f"[{target_name}] EN STOCK - terme positif detecte: {marker}")
@@ -363,7 +848,7 @@ def evaluate_target(
         else:
             log(
                 f"[{target_name}] HORS STOCK - aucun terme positif "
-                f"({', '.join(target['in_stock_terms'])})"
+                f"({target['terms_label']})"
             )
             recipients = target["emails_on_out_of_stock"]
     else:
@@ -373,38 +858,90 @@ def evaluate_target(
         else:
             log(
                 f"[{target_name}] EN STOCK - aucun des termes hors stock "
-                f"({', '.join(target['out_of_stock_terms'])})"
+                f"({target['terms_label']})"
             )
             recipients = target["emails_on_in_stock"]
 
     should_notify = target["notify_on_same_state"] or previous_state != current_state
     if should_notify:
         if recipients:
-            subject_state = "EN STOCK" if current_state == "in_stock" else "HORS STOCK"
-            marker_line = marker if marker else "aucun"
-            body = (
-                f"Cible: {target_name}\n"
-                f"URL: {url}\n"
-                f"Etat: {subject_state}\n"
-                f"Terme detecte: {marker_line}\n"
-                f"Date: {now.isoformat(timespec='seconds')}\n"
-            )
-            send_email(
-                f"[Stock Monitor] {subject_state} - {target_name}",
-                body,
-                recipients,
+            notifications.append(
+                {
+                    "target_name": target_name,
+                    "url": url,
+                    "state": current_state,
+                    "marker": marker,
+                    "recipients": recipients,
+                }
             )
         else:
             log(f"[{target_name}] Aucun destinataire configure pour l'etat {current_state}.")
     else:
         log(f"[{target_name}] Etat inchange ({current_state}), pas de notification.")
 
+    previous_cache = target_state.get("http_cache") or {}
+    etag = page["etag"] or (previous_cache.get("etag", "") if page["not_modified"] else "")
+    last_modified = page["last_modified"] or (
+        previous_cache.get("last_modified", "") if page["not_modified"] else ""
+    )
+    if etag or last_modified:
+        target_state["http_cache"] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "cache_key": target["cache_key"],
+        }
+    else:
+        target_state.pop("http_cache", None)
+
     target_state["last_state"] = current_state
     target_state["last_marker"] = marker
-    target_state["last_check_at"] = now.isoformat(timespec="seconds")
+    target_state["last_check_at"] = now_iso
     return True
 
 
+def state_label(state: str) -> str:
+    return "EN STOCK" if state == "in_stock" else "HORS STOCK"
+
+
+def format_notification(notification: dict[str, Any], now_iso: str) -> str:
+    marker_line = notification["marker"] if notification["marker"] else "aucun"
+    return (
+        f"Cible: {notification['target_name']}\n"
+        f"URL: {notification['url']}\n"
+        f"Etat: {state_label(notification['state'])}\n"
+        f"Terme detecte: {marker_line}\n"
+        f"Date: {now_iso}\n"
+    )
+
+
+def send_notifications(notifications: list[dict[str, Any]], now_iso: str) -> None:
+    """Envoie un seul email par groupe de destinataires pour tout le cycle."""
+    groups: dict[frozenset[str], list[dict[str, Any]]] = {}
+    for notification in notifications:
+        groups.setdefault(frozenset(notification["recipients"]), []).append(notification)
+
+    smtp = SmtpSession()
+    try:
+        for group in groups.values():
+            if len(group) == 1:
+                notification = group[0]
+                subject = (
+                    f"[Stock Monitor] {state_label(notification['state'])} - "
+                    f"{notification['target_name']}"
+                )
+            else:
+                counts: dict[str, int] = {}
+                for notification in group:
+                    label = state_label(notification["state"])
+                    counts[label] = counts.get(label, 0) + 1
+                summary = ", ".join(f"{count} {label}" for label, count in counts.items())
+                subject = f"[Stock Monitor] {len(group)} cibles - {summary}"
+            body = "\n".join(format_notification(notification, now_iso) for notification in group)
+            send_email(subject, body, group[0]["recipients"], smtp=smtp)
+    finally:
+        smtp.close()
+
+
 def run_cycle(force_run: bool) -> int:
     config_path = MONITOR_CONFIG_FILE
     state_path = MONITOR_STATE_FILE
@@ -419,20 +956,31 @@ def run_cycle(force_run: bool) -> int:
     targets_state = state.setdefault("targets", {})
     now = datetime.now()
 
-    checked_count = 0
+    due_targets: list[tuple[dict[str, Any], dict[str, Any]]] = []
     for target in config["targets"]:
         target_id = target["id"]
         target_state = targets_state.setdefault(target_id, {})
         if not force_run and not is_target_due(target, target_state, now):
             continue
-        checked_count += 1
-        evaluate_target(target, target_state, now)
-
-    state["updated_at"] = now.isoformat(timespec="seconds")
+        due_targets.append((target, target_state))
+
+    # Aucune page due: l'etat sur disque est deja a jour, inutile de le reecrire.
+    if not due_targets:
+        return 0
+
+    # Meme instant pour tout le cycle: formate une seule fois.
+    now_iso = now.isoformat(timespec="seconds")
+    pages = scan_pages(due_targets)
+    notifications: list[dict[str, Any]] = []
+    for (target, target_state), page in zip(due_targets, pages):
+        evaluate_target(target, target_state, now_iso, page, notifications)
+    if notifications:
+        send_notifications(notifications, now_iso)
+
+    state["updated_at"] = now_iso
     save_state(state_path, state)
 
-    if checked_count:
-        log(f"Cycle termine: {checked_count} page(s) verifiee(s).")
+    log(f"Cycle termine: {len(due_targets)} page(s) verifiee(s).")
     return 0
 
 